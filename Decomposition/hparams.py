@@ -31,8 +31,11 @@ hparams = HParams(
     # data loader
     # root_dir = 'assets/spmel',
     # feat_dir = 'assets/raptf0',
-    root_dir="assets/vctk_full/vctk_full_spmel",
-    feat_dir="assets/vctk_full/vctk_full_raptf0",
+    # root_dir = "assets/vctk_full/vctk_full_spmel",
+    # feat_dir = "assets/vctk_full/vctk_full_raptf0",
+    # spmel and f0 share one tar per speaker, read with utils.NpyShard
+    root_dir="assets/vctk_full_shards",
+    feat_dir="assets/vctk_full_shards",
     batch_size=16,
     mode="train",
     shuffle=True,
@@ -1,24 +1,33 @@
 import os
 import pickle
 import numpy as np
+from utils import NpyShard
 
-rootDir = "assets/vctk_full/vctk_full_spmel"
-targetDir_emb = "assets/vctk_full/vctk_full_emb"
-dirName, subdirList, _ = next(os.walk(rootDir))
+rootDir = "assets/vctk_full_shards"
+targetDir_emb = "assets/vctk_full_emb"
+dirName, _, shardList = next(os.walk(rootDir))
 print("Found directory: %s" % dirName)
 
 
 speakers = []
-for speaker in sorted(subdirList):
+for shard in sorted(shardList):
+    if shard[-4:] != ".tar":
+        continue
+    speaker = shard[:-4]
     print("Processing speaker: %s" % speaker)
     utterances = []
     utterances.append(speaker)
-    _, _, fileList = next(os.walk(os.path.join(dirName, speaker)))
+    fileList = [
+        name[: -len(".spmel.npy")]
+        for name in NpyShard(os.path.join(dirName, shard)).keys()
+        if name.endswith(".spmel.npy")
+    ]
 
     spkid = np.load(os.path.join(targetDir_emb, speaker, speaker + "_avg.npy"))
     utterances.append(spkid)
 
-    # create file list
+    # create file list, speaker/utt resolves to the utt.*.npy members of
+    # <root_dir>/speaker.tar
     for fileName in sorted(fileList):
         utterances.append(os.path.join(speaker, fileName))
     speakers.append(utterances)
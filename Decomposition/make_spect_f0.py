@@ -1,107 +1,248 @@
+import io
 import os
 import sys
+import math
 import pickle
+import multiprocessing
+import tarfile
 import numpy as np
+import soundfile as sf
+import torch
+import webrtcvad
 
+from concurrent.futures import ProcessPoolExecutor
+from numba import njit
 from scipy import signal
+from scipy.ndimage import binary_dilation
+from threadpoolctl import threadpool_limits
 from librosa.filters import mel
 from numpy.random import RandomState
 from pysptk import sptk
 from utils import butter_highpass
-from utils import speaker_normalization
 from utils import pySTFT
 
-import librosa
+from resemblyzer import VoiceEncoder
+from resemblyzer import audio
+from resemblyzer.hparams import (
+    audio_norm_target_dBFS,
+    sampling_rate,
+    vad_max_silence_length,
+    vad_moving_average_width,
+    vad_window_length,
+)
 
-from resemblyzer import VoiceEncoder, preprocess_wav
-
-encoder = VoiceEncoder()
-
-mel_basis = mel(16000, 1024, fmin=90, fmax=7600, n_mels=80).T
 min_level = np.exp(-100 / 20 * np.log(10))
-b, a = butter_highpass(30, 16000, order=5)
-
-spk2gen = pickle.load(open("assets/spk2gen.pkl", "rb"))
 
 
 # Modify as needed
 
 rootDir = "assets/vctk_full"
-targetDir_f0 = "assets/vctk_full_raptf0"
-targetDir = "assets/vctk_full_spmel"
+targetDir_shard = "assets/vctk_full_shards"
+targetDir_emb = "assets/vctk_full_emb"
+
+num_workers = os.cpu_count()
+emb_batch_size = 32
+
+# Per worker process caches, filled by _init_worker
+_worker_state = {}
+
+
+def _init_worker():
+    """Build the filterbank and high-pass filter once per worker process."""
+    # one BLAS thread per worker, num_workers processes already fill the cores
+    threadpool_limits(1)
+    torch.set_num_threads(1)
+    # float32 to match the single precision STFT, so np.dot runs as an sgemm
+    _worker_state["mel_basis"] = np.ascontiguousarray(
+        mel(16000, 1024, fmin=90, fmax=7600, n_mels=80).T, dtype=np.float32
+    )
+    _worker_state["b"], _worker_state["a"] = butter_highpass(30, 16000, order=5)
+
+
+def mel_db_norm(D_mel, min_level):
+    """(20 * log10(max(min_level, D_mel)) - 16 + 100) / 100 in one float32 buffer."""
+    S = np.maximum(D_mel, min_level, dtype=np.float32)
+    np.log10(S, out=S)
+    S *= 0.2
+    S += 0.84
+    return S
+
+
+@njit(cache=True)
+def f0_normalization(f0):
+    """Equivalent of speaker_normalization over the voiced frames, without masks."""
+    n, s = 0, 0.0
+    for v in f0:
+        if v != -1e10:
+            n += 1
+            s += v
+    # no voiced frame, return the contour unchanged like the masked version
+    if n == 0:
+        return f0.astype(np.float32)
+    mean_f0 = s / n
+
+    ss = 0.0
+    for v in f0:
+        if v != -1e10:
+            ss += (v - mean_f0) * (v - mean_f0)
+    std_f0 = math.sqrt(ss / n)
+
+    out = np.empty(f0.shape[0], dtype=np.float32)
+    for i in range(f0.shape[0]):
+        if f0[i] == -1e10:
+            out[i] = f0[i]
+        elif std_f0 == 0:
+            # 0 / 0 in the masked version
+            out[i] = np.nan
+        else:
+            v = (f0[i] - mean_f0) / std_f0 / 4.0
+            out[i] = (min(max(v, -1.0), 1.0) + 1) / 2.0
+    return out
+
+
+def trim_long_silences(wav):
+    """resemblyzer's trim_long_silences, with the VAD input packed by numpy."""
+    samples_per_window = (vad_window_length * sampling_rate) // 1000
+    wav = wav[: len(wav) - (len(wav) % samples_per_window)]
+
+    # 16-bit PCM bytes, struct.pack over a Python tuple cost more than the VAD
+    pcm_wave = np.round(wav * audio.int16_max).astype(np.int16).tobytes()
+
+    vad = webrtcvad.Vad(mode=3)
+    voice_flags = np.array(
+        [
+            vad.is_speech(
+                pcm_wave[window_start * 2 : (window_start + samples_per_window) * 2],
+                sample_rate=sampling_rate,
+            )
+            for window_start in range(0, len(wav), samples_per_window)
+        ]
+    )
+
+    # smooth the voice detection with a moving average, then dilate it
+    width = vad_moving_average_width
+    flags_padded = np.concatenate(
+        (np.zeros((width - 1) // 2), voice_flags, np.zeros(width // 2))
+    )
+    ret = np.cumsum(flags_padded, dtype=float)
+    ret[width:] = ret[width:] - ret[:-width]
+    audio_mask = np.round(ret[width - 1 :] / width).astype(bool)
+    audio_mask = binary_dilation(audio_mask, np.ones(vad_max_silence_length + 1))
+    audio_mask = np.repeat(audio_mask, samples_per_window)
+
+    return wav[audio_mask]
+
+
+def preprocess_uttr(wav):
+    """Equivalent of resemblyzer's preprocess_wav for a 16 kHz waveform."""
+    wav = audio.normalize_volume(wav, audio_norm_target_dBFS, increase_only=True)
+    return trim_long_silences(wav)
+
+
+def partial_mels(wav, rate=1.3, min_coverage=0.75):
+    """Partial mel slices of a preprocessed wav, as cut by encoder.embed_utterance."""
+    wav_slices, mel_slices = VoiceEncoder.compute_partial_slices(
+        len(wav), rate, min_coverage
+    )
+    max_wave_length = wav_slices[-1].stop
+    if max_wave_length >= len(wav):
+        wav = np.pad(wav, (0, max_wave_length - len(wav)), "constant")
+    mel = audio.wav_to_mel_spectrogram(wav)
+    return np.stack([mel[s] for s in mel_slices])
+
 
-dirName, subdirList, _ = next(os.walk(rootDir))
-print("Found directory: %s" % dirName)
+def embed_utterances(encoder, uttr_mels, batch_size=32):
+    """Batched equivalent of encoder.embed_utterance over partial_mels outputs."""
+    embeds = []
+    for i in range(0, len(uttr_mels), batch_size):
+        batch = uttr_mels[i : i + batch_size]
+        n_partials = [len(mels) for mels in batch]
 
-for subdir in sorted(subdirList):
+        # Run all partials of the batch through the encoder at once
+        with torch.no_grad(), torch.autocast(
+            device_type=encoder.device.type,
+            dtype=torch.float16,
+            enabled=encoder.device.type == "cuda",
+        ):
+            mels = torch.from_numpy(np.concatenate(batch)).to(encoder.device)
+            partial_embeds = encoder(mels).float().cpu().numpy()
+
+        # Average the partials of each utterance and L2 normalize in fp32
+        for partials in np.split(partial_embeds, np.cumsum(n_partials)[:-1]):
+            raw_embed = np.mean(partials, axis=0)
+            embeds.append(raw_embed / np.linalg.norm(raw_embed, 2))
+
+    return embeds
+
+
+def add_npy(tar, name, arr):
+    """Serialize arr in .npy format as a member of an open tar file."""
+    buf = io.BytesIO()
+    np.save(buf, arr, allow_pickle=False)
+    info = tarfile.TarInfo(name)
+    info.size = buf.tell()
+    buf.seek(0)
+    tar.addfile(info, buf)
+
+
+def process_file(task):
+    """Compute the spectrogram, normalized f0 and encoder mel slices of one file."""
+    subdir, fileName, lo, hi, index = task
+    # Seed from (speaker, file index) so the dither does not depend on which
+    # worker handles the file
+    prng = RandomState([int(subdir[1:]), index])
+
+    # read audio file, resampling only when it is not already at 16 kHz
+    x, fs = sf.read(os.path.join(rootDir, subdir, fileName), dtype="float32")
+    if x.ndim > 1:
+        x = x.mean(axis=1)
+    if fs != 16000:
+        x = signal.resample_poly(x, 16000, fs)
+        fs = 16000
+    if x.shape[0] % 256 == 0:
+        x = np.pad(x, (0, 1), constant_values=1e-06)
+    y = signal.filtfilt(_worker_state["b"], _worker_state["a"], x)
+    wav = y * 0.96 + (prng.rand(y.shape[0]) - 0.5) * 1e-06
+
+    # cut the speaker encoder input into partial mel slices, embedded in
+    # batches by the parent
+    mels_emb = partial_mels(preprocess_uttr(wav).astype(np.float32))
+
+    # compute spectrogram
+    D = pySTFT(wav, dtype=np.float32).T
+    D_mel = np.dot(D, _worker_state["mel_basis"])
+    S = mel_db_norm(D_mel, min_level)
+
+    # extract f0
+    f0_rapt = sptk.rapt(
+        wav.astype(np.float32) * 32768, fs, 256, min=lo, max=hi, otype=2
+    )
+    f0_norm = f0_normalization(f0_rapt)
+
+    assert len(S) == len(f0_rapt)
+
+    return S, f0_norm, mels_emb
+
+
+def save_speaker(encoder, subdir, fileList, results):
+    """Embed the utterances of one speaker and write its shard and average."""
     print(subdir)
 
-    if not os.path.exists(os.path.join(targetDir, subdir)):
-        os.makedirs(os.path.join(targetDir, subdir))
-    if not os.path.exists(os.path.join(targetDir_f0, subdir)):
-        os.makedirs(os.path.join(targetDir_f0, subdir))
-    if not os.path.exists(os.path.join(targetDir_emb, subdir)):
-        os.makedirs(os.path.join(targetDir_emb, subdir))
-    _, _, fileList = next(os.walk(os.path.join(dirName, subdir)))
-
-    if spk2gen[subdir] == "M":
-        lo, hi = 50, 250
-    elif spk2gen[subdir] == "F":
-        lo, hi = 100, 600
-    else:
-        raise ValueError
-
-    prng = RandomState(int(subdir[1:]))
-    uttr_embs = []
-    for fileName in sorted(fileList):
-        # read audio file
-        ## x, fs = sf.read(os.path.join(dirName,subdir,fileName))
-        if fileName[-4:] != ".wav":  # del
-            continue
-        x, fs = librosa.load(os.path.join(dirName, subdir, fileName), sr=16000)
-        assert fs == 16000
-        if x.shape[0] % 256 == 0:
-            x = np.concatenate((x, np.array([1e-06])), axis=0)
-        y = signal.filtfilt(b, a, x)
-        wav = y * 0.96 + (prng.rand(y.shape[0]) - 0.5) * 1e-06
-
-        # compute speaker embedding
-        uttr_emb = encoder.embed_utterance(preprocess_wav(wav, source_sr=16000))
-        uttr_embs.append(uttr_emb)
-
-        # compute spectrogram
-        D = pySTFT(wav).T
-        D_mel = np.dot(D, mel_basis)
-        D_db = 20 * np.log10(np.maximum(min_level, D_mel)) - 16
-        S = (D_db + 100) / 100
-
-        # extract f0
-        f0_rapt = sptk.rapt(
-            wav.astype(np.float32) * 32768, fs, 256, min=lo, max=hi, otype=2
-        )
-        index_nonzero = f0_rapt != -1e10
-        mean_f0, std_f0 = np.mean(f0_rapt[index_nonzero]), np.std(
-            f0_rapt[index_nonzero]
-        )
-        f0_norm = speaker_normalization(f0_rapt, index_nonzero, mean_f0, std_f0)
-
-        assert len(S) == len(f0_rapt)
-
-        np.save(
-            os.path.join(targetDir, subdir, fileName[:-4]),
-            S.astype(np.float32),
-            allow_pickle=False,
-        )
-        np.save(
-            os.path.join(targetDir_f0, subdir, fileName[:-4]),
-            f0_norm.astype(np.float32),
-            allow_pickle=False,
-        )
-        np.save(
-            os.path.join(targetDir_emb, subdir, fileName[:-4]),
-            uttr_emb.astype(np.float32),
-            allow_pickle=False,
-        )
+    spmels, f0s, mels_emb = [], [], []
+    for S, f0_norm, uttr_mels in results:
+        spmels.append(S)
+        f0s.append(f0_norm)
+        mels_emb.append(uttr_mels)
+
+    # compute speaker embeddings
+    uttr_embs = embed_utterances(encoder, mels_emb, batch_size=emb_batch_size)
+
+    # one shard per speaker, the members of an utterance kept adjacent
+    with tarfile.open(os.path.join(targetDir_shard, subdir + ".tar"), "w") as tar:
+        for fileName, S, f0_norm, uttr_emb in zip(fileList, spmels, f0s, uttr_embs):
+            add_npy(tar, fileName[:-4] + ".spmel.npy", S)
+            add_npy(tar, fileName[:-4] + ".f0.npy", f0_norm)
+            add_npy(tar, fileName[:-4] + ".emb.npy", uttr_emb)
 
     spkr_emb = np.array(uttr_embs).mean(axis=0)
     np.save(
@@ -109,3 +250,52 @@ for subdir in sorted(subdirList):
         spkr_emb.astype(np.float32),
         allow_pickle=False,
     )
+
+
+if __name__ == "__main__":
+    spk2gen = pickle.load(open("assets/spk2gen.pkl", "rb"))
+
+    encoder = VoiceEncoder(device="cuda" if torch.cuda.is_available() else "cpu")
+
+    dirName, subdirList, _ = next(os.walk(rootDir))
+    print("Found directory: %s" % dirName)
+
+    if not os.path.exists(targetDir_shard):
+        os.makedirs(targetDir_shard)
+
+    # spawn, the workers start on the first map, when the parent already
+    # holds a CUDA context that must not be forked
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+    ) as executor:
+        previous = None
+        for subdir in sorted(subdirList):
+            if not os.path.exists(os.path.join(targetDir_emb, subdir)):
+                os.makedirs(os.path.join(targetDir_emb, subdir))
+            _, _, fileList = next(os.walk(os.path.join(dirName, subdir)))
+            fileList = [
+                fileName for fileName in sorted(fileList) if fileName[-4:] == ".wav"
+            ]
+
+            if spk2gen[subdir] == "M":
+                lo, hi = 50, 250
+            elif spk2gen[subdir] == "F":
+                lo, hi = 100, 600
+            else:
+                raise ValueError
+
+            tasks = [
+                (subdir, fileName, lo, hi, i) for i, fileName in enumerate(fileList)
+            ]
+            results = executor.map(process_file, tasks, chunksize=8)
+
+            # Queue this speaker on the workers before the parent embeds and
+            # writes the previous one, so the pool stays busy meanwhile
+            if previous is not None:
+                save_speaker(encoder, *previous)
+            previous = (subdir, fileList, results)
+
+        if previous is not None:
+            save_speaker(encoder, *previous)
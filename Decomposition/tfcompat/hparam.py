@@ -144,6 +144,8 @@ def parse_values(values, type_map):
 
 
 class HParams(object):
+
+  def __init__(self, hparam_def=None, model_structure=None, **kwargs):
     self._hparam_types = {}
     self._model_structure = model_structure
     if hparam_def:
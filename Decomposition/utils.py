@@ -1,6 +1,10 @@
+import io
 import copy
+import tarfile
+import functools
 import torch
 import numpy as np
+from scipy import fft
 from scipy import signal
 from librosa.filters import mel
 from scipy.signal import get_window
@@ -15,9 +19,15 @@ def butter_highpass(cutoff, fs, order=5):
     
     
     
-def pySTFT(x, fft_length=1024, hop_length=256):
+@functools.lru_cache(maxsize=None)
+def _hann_window(fft_length, dtype):
+    return get_window('hann', fft_length, fftbins=True).astype(dtype)
     
-    x = np.pad(x, int(fft_length//2), mode='reflect')
+    
+    
+def pySTFT(x, fft_length=1024, hop_length=256, dtype=np.float64):
+    
+    x = np.pad(x.astype(dtype, copy=False), int(fft_length//2), mode='reflect')
     
     noverlap = fft_length - hop_length
     shape = x.shape[:-1]+((x.shape[-1]-noverlap)//hop_length, fft_length)
@@ -25,8 +35,9 @@ def pySTFT(x, fft_length=1024, hop_length=256):
     result = np.lib.stride_tricks.as_strided(x, shape=shape,
                                              strides=strides)
     
-    fft_window = get_window('hann', fft_length, fftbins=True)
-    result = np.fft.rfft(fft_window * result, n=fft_length).T
+    # scipy.fft runs in single precision when dtype is float32
+    fft_window = _hann_window(fft_length, dtype)
+    result = fft.rfft(fft_window * result, n=fft_length).T
     
     return np.abs(result)    
 
@@ -85,4 +96,41 @@ def get_mask_from_lengths(lengths, max_len):
 def pad_seq_to_2(x, len_out=128):
     len_pad = (len_out - x.shape[1])
     assert len_pad >= 0
-    return np.pad(x, ((0,0),(0,len_pad),(0,0)), 'constant'), len_pad    
\ No newline at end of file
+    return np.pad(x, ((0,0),(0,len_pad),(0,0)), 'constant'), len_pad    
+
+
+
+class NpyShard(object):
+    """Read access to the .npy members of a tar shard from make_spect_f0.
+    
+    The tar is scanned once for the data offset and size of every member.
+    Members are returned as read-only views on an mmap of the whole shard,
+    so only the pages actually indexed are read from disk.
+    """
+    
+    def __init__(self, path):
+        with tarfile.open(path) as tar:
+            self.index = {info.name: (info.offset_data, info.size)
+                          for info in tar if info.isfile()}
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        
+    def keys(self):
+        return self.index.keys()
+    
+    def __contains__(self, name):
+        return name in self.index
+    
+    def __getitem__(self, name):
+        offset, size = self.index[name]
+        # the .npy headers written by make_spect_f0 fit well within a page
+        header = io.BytesIO(self.data[offset:offset+min(size, 4096)])
+        version = np.lib.format.read_magic(header)
+        if version == (1, 0):
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_1_0(header)
+        else:
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_2_0(header)
+        return np.ndarray(shape, dtype, buffer=self.data,
+                          offset=offset+header.tell(),
+                          order='F' if fortran_order else 'C')
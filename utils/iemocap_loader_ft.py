@@ -1,4 +1,5 @@
 import os
+import functools
 import torch
 
 # import pickle
@@ -9,12 +10,20 @@ import os
 from sklearn.model_selection import train_test_split
 from sklearn.utils.class_weight import compute_class_weight
 from hparams import hparams
-import copy
+
+
+@functools.lru_cache(maxsize=None)
+def class_weights(labels):
+    """Balanced class weights, cached on the int64 training labels as bytes."""
+    y = np.frombuffer(labels, dtype=np.int64)
+    return compute_class_weight("balanced", classes=np.unique(y), y=y)
 
 
 class IEMOCAP(data.Dataset):
     """Dataset class for the IEMOCAP dataset."""
 
+    item_columns = ["path_spmel", "path_raptf0", "path_emb", "emotion"]
+
     def __init__(self, selected_emos, mode, meta=None):
         """Initialize and preprocess the IEMOCAP dataset."""
 
@@ -28,6 +37,10 @@ class IEMOCAP(data.Dataset):
         self.meta_val = None
         self.meta_test = None
 
+        self.items_train = None
+        self.items_val = None
+        self.items_test = None
+
         self.class_weight = None
 
         if meta is None:
@@ -35,7 +48,9 @@ class IEMOCAP(data.Dataset):
                 "/vol/bitbucket/apg416/project/decomposition/assets/iemocap_meta.csv"
             )
         else:
-            self.meta = copy.deepcopy(meta)
+            # preprocess() only rebinds self.meta, the caller's frame is not
+            # modified, so a shallow copy is enough
+            self.meta = meta.copy(deep=False)
 
         self.preprocess()
 
@@ -45,9 +60,9 @@ class IEMOCAP(data.Dataset):
         # Retain only the chosen classes and encode them
         self.meta = self.meta.loc[self.meta["emotion"].isin(self.selected_emos)]
 
-        self.meta["emotion"].replace(self.emo2idx, inplace=True)
+        self.meta = self.meta.assign(emotion=self.meta["emotion"].map(self.emo2idx))
 
-        self.meta["session"] = self.meta["wav_file"].apply(lambda s: s[3:5])
+        self.meta = self.meta.assign(session=self.meta["wav_file"].str[3:5])
 
         self.meta_train = self.meta[
             (self.meta["session"] == "01")
@@ -61,13 +76,14 @@ class IEMOCAP(data.Dataset):
         self.meta_val.reset_index(inplace=True)
         self.meta_test.reset_index(inplace=True)
 
+        # Cache the per-sample fields as arrays so __getitem__ avoids pandas
+        self.items_train = self.meta_train[self.item_columns].to_numpy()
+        self.items_val = self.meta_val[self.item_columns].to_numpy()
+        self.items_test = self.meta_test[self.item_columns].to_numpy()
+
         # Compute class weightings
-        self.class_weight = torch.from_numpy(
-            compute_class_weight(
-                "balanced",
-                classes=np.unique(self.meta_train.emotion.values),
-                y=self.meta_train.emotion.values,
-            )
+        self.class_weight = torch.tensor(
+            class_weights(self.meta_train.emotion.values.astype(np.int64).tobytes())
         )
 
         print("Finished preprocessing the IEMOCAP dataset...")
@@ -77,20 +93,17 @@ class IEMOCAP(data.Dataset):
         """Return one mel spectrogram and its corresponding emotion label."""
         # meta = self.meta_train if self.mode == 'train' else self.meta_test
         if self.mode == "train":
-            meta = self.meta_train
+            items = self.items_train
         elif self.mode == "val":
-            meta = self.meta_val
+            items = self.items_val
         else:
-            meta = self.meta_test
-
-        path_spmel, path_raptf0, path_emb = meta.loc[
-            index, ["path_spmel", "path_raptf0", "path_emb"]
-        ]
+            items = self.items_test
 
-        emo = meta.loc[index, "emotion"]
+        path_spmel, path_raptf0, path_emb, emo = items[index]
 
-        melsp = np.load(path_spmel + ".npy")
-        f0_org = np.load(path_raptf0 + ".npy")
+        # Memory-map the frame-level features, MyCollator only reads the crop
+        melsp = np.load(path_spmel + ".npy", mmap_mode="r")
+        f0_org = np.load(path_raptf0 + ".npy", mmap_mode="r")
         emb_org = np.load(path_emb + ".npy")
 
         return melsp, emb_org, f0_org, emo
@@ -113,36 +126,38 @@ class MyCollator(object):
 
     def __call__(self, batch):
         # batch[i] is a tuple of __getitem__ outputs
-        new_batch = []
-        for token in batch:
-            aa, b, c, emo = token
-            if len(aa) > self.max_len_seq:
-                len_crop = self.max_len_seq
-                left = np.random.randint(0, len(aa) - len_crop)
-                a = aa[left : left + len_crop, :]
-                c = c[left : left + len_crop]
-            else:
-                len_crop = len(aa)
-                a = aa
-            a = np.clip(a, 0, 1)
-
-            a_pad = np.pad(a, ((0, self.max_len_pad - a.shape[0]), (0, 0)), "constant")
-            c_pad = np.pad(
-                c[:, np.newaxis],
-                ((0, self.max_len_pad - c.shape[0]), (0, 0)),
-                "constant",
-                constant_values=-1e10,
-            )
-
-            new_batch.append((a_pad, b, c_pad, len_crop, emo))
-
-        batch = new_batch
+        aa, b, c, e = zip(*batch)
+
+        len_org = np.array([len(a) for a in aa])
+        len_crop = np.minimum(len_org, self.max_len_seq)
+        # Draw all crop offsets at once, 0 for utterances that are not cropped
+        left = np.random.randint(0, np.maximum(len_org - self.max_len_seq, 1))
+
+        # Collating in the main process, allocate the batch pinned so the
+        # DataLoader does not make its own pinned copy. Worker outputs are
+        # moved through shared memory and pinned by the DataLoader instead.
+        pin = torch.cuda.is_available() and data.get_worker_info() is None
+
+        # Fill preallocated padded buffers in place of per-sample pad + stack
+        melsp = torch.zeros(
+            (len(batch), self.max_len_pad, aa[0].shape[1]),
+            dtype=torch.float32,
+            pin_memory=pin,
+        )
+        pitch = torch.full(
+            (len(batch), self.max_len_pad, 1),
+            -1e10,
+            dtype=torch.float32,
+            pin_memory=pin,
+        )
+        melsp_np, pitch_np = melsp.numpy(), pitch.numpy()
+        for i in range(len(batch)):
+            crop = slice(left[i], left[i] + len_crop[i])
+            np.clip(aa[i][crop], 0, 1, out=melsp_np[i, : len_crop[i]])
+            pitch_np[i, : len_crop[i], 0] = c[i][crop]
 
-        a, b, c, d, e = zip(*batch)
-        melsp = torch.from_numpy(np.stack(a, axis=0))
         spk_emb = torch.from_numpy(np.stack(b, axis=0))
-        pitch = torch.from_numpy(np.stack(c, axis=0))
-        len_org = torch.from_numpy(np.stack(d, axis=0))
+        len_org = torch.from_numpy(len_crop)
         emo_org = torch.from_numpy(np.stack(e, axis=0))
 
         return melsp, spk_emb, pitch, len_org
@@ -162,12 +177,19 @@ def get_loader(
 
     my_collator = MyCollator(hparams)
 
+    # Worker options are only accepted with multiprocess loading
+    worker_kwargs = (
+        dict(persistent_workers=True, prefetch_factor=4) if num_workers > 0 else {}
+    )
+
     data_loader = data.DataLoader(
         dataset=dataset,
         batch_size=batch_size,
         shuffle=(mode == "train"),
         collate_fn=my_collator,
-        num_workers=1,
+        num_workers=num_workers,
+        pin_memory=torch.cuda.is_available(),
         drop_last=drop_last,
+        **worker_kwargs,
     )
     return data_loader